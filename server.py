@@ -1,14 +1,18 @@
 #!/usr/bin/env python3
 
 import argparse
+import fcntl
 import http.server
 import json
 import logging
 import os
-import shutil
+import queue
+import selectors
 import signal
+import socket
 import socketserver
 import threading
+import time
 import webbrowser
 
 try:
@@ -17,6 +21,12 @@ try:
 except Exception:
     pass
 
+try:
+    import watchdog.events
+    import watchdog.observers
+except ImportError:
+    watchdog = None
+
 # Set up logger
 logging.basicConfig(
     format='[%(asctime)s] %(message)s',
@@ -25,27 +35,195 @@ logging.basicConfig(
 )
 logger = logging.getLogger()
 
-# Events and the controlling lock
-should_wakeup = threading.Event()
-should_update = threading.Event()
-server_shutting_down = threading.Event()
-events_lock = threading.RLock()
+# Connected /events clients; see Subscriber. The lock guards membership
+# changes and posting of messages, and is never held while writing to a
+# socket. It is not reentrant, so it must never be taken from a signal
+# handler; signal handlers hand their work off to other threads instead.
+subscribers = set()
+subscribers_lock = threading.Lock()
+
+# Each /events client ties up a thread, so cap how many we keep around
+MAX_SUBSCRIBERS = 64
+
+# The served file (see ServedFile), kept open between requests and only
+# reopened if the path comes to refer to another file. Alongside it, the
+# formatted Content-Length and Last-Modified values, keyed by
+# (st_mtime_ns, st_size).
+_served = {'file': None, 'headers': (None, None, None)}
+_served_lock = threading.Lock()
+
+# Set to have the updater thread push fresh content to all subscribers;
+# repeated requests made before the updater gets to it are coalesced
+update_requested = threading.Event()
+
+# Seconds to wait for a burst of update requests to settle
+UPDATE_DEBOUNCE = 0.05
+
+# Chunk size for copying the served file when sendfile(2) is unavailable
+COPY_BUFSIZE = 65536
 
-def extract_manpage_content(path):
+# Seconds between keep-alive comments on an idle event stream
+HEARTBEAT_INTERVAL = 15
+
+def read_file(path):
     try:
-        with open(path) as f:
-            recording = False
-            content = ''
-            for line in f:
-                if recording:
-                    content += line
-                if line == '<pre id="manpage">\n':
-                    recording = True
-                if line == '</pre>\n':
-                    break
-        return content
+        with open(path, 'rb') as f:
+            return f.read()
     except OSError:
+        return b''
+
+def extract_manpage_content(data):
+    start = data.find(b'<pre id="manpage">\n')
+    if start == -1:
         return ''
+    start += len(b'<pre id="manpage">\n')
+    end = data.find(b'</pre>\n', start)
+    end = len(data) if end == -1 else end + len(b'</pre>\n')
+    return data[start:end].decode('utf-8', errors='replace')
+
+class ServedFile(object):
+
+    # Requests only use positional I/O on the file, so it can be shared
+    # between threads. It is closed once it has been retired and the last
+    # request using it is done.
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.users = 0
+        self.retired = False
+
+def checkout_served_file(path):
+    with _served_lock:
+        served = _served['file']
+        if served is None:
+            served = ServedFile(path)
+            _served['file'] = served
+        served.users += 1
+    return served
+
+def checkin_served_file(served):
+    with _served_lock:
+        served.users -= 1
+        close = served.retired and served.users == 0
+    if close:
+        served.file.close()
+
+def refresh_served_file(path):
+    # pm rewrites the file in place, so the open file normally stays good;
+    # only retire it if the path now refers to a different file
+    with _served_lock:
+        served = _served['file']
+        if served is None:
+            return
+        try:
+            st = os.stat(path)
+            fs = os.fstat(served.file.fileno())
+            if (st.st_dev, st.st_ino) == (fs.st_dev, fs.st_ino):
+                return
+        except OSError:
+            pass
+        _served['file'] = None
+        served.retired = True
+        close = served.users == 0
+    if close:
+        served.file.close()
+
+class Subscriber(object):
+
+    # Messages are posted to a queue, and a byte is written to a pipe to
+    # wake the client's handler, which waits on the pipe and its socket
+    # at the same time so that a hangup is noticed right away.
+
+    def __init__(self):
+        self.messages = queue.Queue()
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        flags = fcntl.fcntl(self.wakeup_w, fcntl.F_GETFL)
+        fcntl.fcntl(self.wakeup_w, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def post(self, message):
+        self.messages.put_nowait(message)
+        try:
+            os.write(self.wakeup_w, b'x')
+        except BlockingIOError:
+            # The pipe is full, so the handler is due to wake up anyway
+            pass
+
+    def close(self):
+        os.close(self.wakeup_r)
+        os.close(self.wakeup_w)
+
+def subscribe():
+    with subscribers_lock:
+        if len(subscribers) >= MAX_SUBSCRIBERS:
+            return None
+        subscriber = Subscriber()
+        subscribers.add(subscriber)
+    return subscriber
+
+def unsubscribe(subscriber):
+    with subscribers_lock:
+        subscribers.discard(subscriber)
+    subscriber.close()
+
+def broadcast(event, data):
+    # The encoded frame is built once and shared by all recipients
+    frame = b'event: ' + event.encode('utf-8') + b'\ndata: ' + data + b'\n\n'
+    message = (event, frame)
+    # Posting is held under the lock so that a subscriber's pipe is not
+    # closed under us
+    with subscribers_lock:
+        for subscriber in subscribers:
+            subscriber.post(message)
+
+def update_forever(path):
+    last_data = None
+    while True:
+        update_requested.wait()
+        # The file is often rewritten several times in quick succession;
+        # only read it once things have quieted down
+        update_requested.clear()
+        while update_requested.wait(UPDATE_DEBOUNCE):
+            update_requested.clear()
+        refresh_served_file(path)
+        data = read_file(path)
+        if data == last_data:
+            # This exact file was already pushed, e.g. by the file watcher
+            # before SIGUSR1 for the same change
+            continue
+        logger.info('Updating content...')
+        updated_content = {
+            'content': extract_manpage_content(data)
+        }
+        broadcast('update', json.dumps(updated_content).encode('utf-8'))
+        last_data = data
+
+def watch_file(path):
+    # Request an update whenever the file is closed after writing or
+    # renamed into place. Only supported with watchdog on inotify-based
+    # platforms; elsewhere we rely on SIGUSR1 alone.
+    if watchdog is None:
+        return None
+    path = os.path.abspath(path)
+
+    class Handler(watchdog.events.FileSystemEventHandler):
+
+        def on_closed(self, event):
+            if os.path.abspath(event.src_path) == path:
+                update_requested.set()
+
+        def on_moved(self, event):
+            if os.path.abspath(event.dest_path) == path:
+                update_requested.set()
+
+    observer = watchdog.observers.Observer()
+    observer.schedule(Handler(), os.path.dirname(path), recursive=False)
+    observer.daemon = True
+    try:
+        observer.start()
+    except Exception:
+        logger.warning('Warning: Failed to watch %s for changes.', path)
+        return None
+    return observer
 
 def open_url(url):
     # Redirect stdout and stderr to /dev/null on the OS level so that
@@ -71,55 +249,145 @@ class PMHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
 
     file_path = None
 
+    # Event frames are small; don't let Nagle's algorithm hold them back
+    disable_nagle_algorithm = True
+
+    # (second, formatted value) of the most recent Date header
+    _date = (None, None)
+
+    def date_time_string(self, timestamp=None):
+        # Format the current time at most once per second
+        if timestamp is not None:
+            return http.server.BaseHTTPRequestHandler.date_time_string(self, timestamp)
+        now = int(time.time())
+        second, value = PMHTTPRequestHandler._date
+        if second != now:
+            value = http.server.BaseHTTPRequestHandler.date_time_string(self, now)
+            PMHTTPRequestHandler._date = (now, value)
+        return value
+
     def __write(self, msg):
-        self.wfile.write(msg.encode('utf-8'))
+        self.wfile.write(msg)
+        self.wfile.flush()
+
+    def __cork(self, corked):
+        # While corked, the kernel holds back partial frames so that the
+        # headers and a small body go out in the same segment (Linux only)
+        if hasattr(socket, 'TCP_CORK'):
+            try:
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK,
+                                           1 if corked else 0)
+            except OSError:
+                pass
+
+    def __send_file(self, f, size):
+        # Let the kernel copy the file straight to the socket, falling back
+        # to copying through userspace where sendfile(2) is unavailable
         self.wfile.flush()
+        offset = 0
+        try:
+            while offset < size:
+                sent = os.sendfile(self.connection.fileno(), f.fileno(),
+                                   offset, size - offset)
+                if sent == 0:
+                    break
+                offset += sent
+        except ConnectionError:
+            raise
+        except (AttributeError, OSError):
+            while offset < size:
+                buf = os.pread(f.fileno(), min(size - offset, COPY_BUFSIZE), offset)
+                if not buf:
+                    break
+                self.wfile.write(buf)
+                offset += len(buf)
+
+    def __send_pending(self, messages):
+        # Send queued messages, skipping updates superseded by ones queued
+        # behind them. Returns True once the stream has been closed.
+        update = None
+        while True:
+            try:
+                event, frame = messages.get_nowait()
+            except queue.Empty:
+                break
+            if event == 'update':
+                update = frame
+            elif event == 'bye':
+                if update is not None:
+                    self.__write(update)
+                self.__write(frame)
+                self.close_connection = True
+                return True
+        if update is not None:
+            self.__write(update)
+        return False
 
     def do_GET(self):
         if self.path == '/':
+            self.__cork(True)
             self.send_response(200)
             self.send_header("Content-Type", "text/html")
+            served = None
             try:
-                with open(self.file_path, 'rb') as f:
-                    fs = os.fstat(f.fileno())
-                    self.send_header("Content-Length", str(fs.st_size))
-                    self.send_header("Last-Modified", self.date_time_string(fs.st_mtime))
-                    self.end_headers()
-                    shutil.copyfileobj(f, self.wfile)
+                served = checkout_served_file(self.file_path)
+                f = served.file
+                # pm rewrites the file in place before signaling us, so the
+                # size and mtime are still checked on every request
+                fs = os.fstat(f.fileno())
+                key = (fs.st_mtime_ns, fs.st_size)
+                cached_key, length, last_modified = _served['headers']
+                if key != cached_key:
+                    length = str(fs.st_size)
+                    last_modified = self.date_time_string(fs.st_mtime)
+                    _served['headers'] = (key, length, last_modified)
+                self.send_header("Content-Length", length)
+                self.send_header("Last-Modified", last_modified)
+                self.end_headers()
+                self.__send_file(f, fs.st_size)
             except OSError:
                 self.send_header("Content-Length", "0")
                 self.end_headers()
+            finally:
+                if served is not None:
+                    checkin_served_file(served)
+                self.__cork(False)
         elif self.path == '/events':
+            subscriber = subscribe()
+            if subscriber is None:
+                self.send_error(503, 'Too many event streams')
+                return
             self.send_response(200)
             self.send_header("Content-Type", "text/event-stream")
             self.end_headers()
-            socket_closed_by_other_end = False
-            while True:
-                should_wakeup.wait()
-                events_lock.acquire()
-                if should_update.is_set():
-                    updated_content = {
-                        'content': extract_manpage_content(self.file_path)
-                    }
-                    try:
-                        self.__write('event: update\n')
-                        self.__write('data: ' + json.dumps(updated_content) + '\n\n')
-                    except BrokenPipeError:
-                        socket_closed_by_other_end = True
-                    should_update.clear()
-                if server_shutting_down.is_set():
-                    try:
-                        self.__write('event: bye\n')
-                        self.__write('data: {}\n\n')
-                    except BrokenPipeError:
-                        socket_closed_by_other_end = True
-                    self.close_connection = True
-                    break
-                should_wakeup.clear()
-                events_lock.release()
-                if socket_closed_by_other_end:
-                    logger.warning('Warning: Socket closed by the other end.')
-                    break
+            selector = selectors.DefaultSelector()
+            try:
+                # Have the client reconnect quickly if the server restarts
+                self.__write(b'retry: 2000\n\n')
+                selector.register(subscriber.wakeup_r, selectors.EVENT_READ)
+                selector.register(self.connection, selectors.EVENT_READ)
+                while True:
+                    ready = selector.select(timeout=HEARTBEAT_INTERVAL)
+                    if not ready:
+                        # Keep-alive comment, ignored by EventSource
+                        self.__write(b': ping\n\n')
+                        continue
+                    for key, _ in ready:
+                        if key.fileobj is self.connection:
+                            if self.connection.recv(1, socket.MSG_PEEK) == b'':
+                                raise ConnectionAbortedError
+                            # The client isn't supposed to send anything
+                            # more; stop watching rather than spin on it
+                            selector.unregister(self.connection)
+                        else:
+                            os.read(subscriber.wakeup_r, 4096)
+                    if self.__send_pending(subscriber.messages):
+                        break
+            except ConnectionError:
+                logger.warning('Warning: Socket closed by the other end.')
+            finally:
+                selector.close()
+                unsubscribe(subscriber)
         else:
             self.send_error(404)
 
@@ -139,31 +407,37 @@ def main():
     port = httpd.server_port
     url = 'http://localhost:%d' % port
 
+    def stop():
+        broadcast('bye', b'{}')
+        httpd.shutdown()
+
     def shutdown_server(signum, stackframe):
         logger.info('Shutting down HTTP server...')
-        events_lock.acquire()
-        server_shutting_down.set()
-        should_wakeup.set()
-        events_lock.release()
-        httpd.shutdown()
+        # Stop from another thread: broadcast() takes subscribers_lock,
+        # which a nested signal handler on this thread could deadlock on,
+        # and shutdown() waits for serve_forever() to return, which cannot
+        # happen while this handler is running on the serving thread
+        threading.Thread(target=stop).start()
 
     signal.signal(signal.SIGINT, shutdown_server)
     signal.signal(signal.SIGTERM, shutdown_server)
 
     def update_content(signum, stackframe):
-        logger.info('Updating content...')
-        events_lock.acquire()
-        should_update.set()
-        should_wakeup.set()
-        events_lock.release()
+        update_requested.set()
 
     signal.signal(signal.SIGUSR1, update_content)
 
+    updater_thread = threading.Thread(target=update_forever, args=(args.file,))
+    updater_thread.daemon = True
+    updater_thread.start()
+    watch_file(args.file)
+
     logger.info('HTTP server listening on %s', url)
-    httpd_thread = threading.Thread(target=httpd.serve_forever)
-    httpd_thread.start()
+    browser_thread = threading.Thread(target=open_url, args=(url,))
+    browser_thread.daemon = True
+    browser_thread.start()
 
-    open_url(url)
+    httpd.serve_forever()
 
 if __name__ == '__main__':
     main()